@@ -2,7 +2,8 @@
 
 import GPy
 import numpy as np
-from .gp_models_utils_casadi import gp_pred_function, _get_kernel_function
+from .gp_models_utils_casadi import gp_pred_function, _get_kernel_function, \
+    GPPredictor
 from ..state_space_models import StateSpaceModel
 from GPy.util.linalg import pdinv
 import numpy.linalg as nLa
@@ -52,6 +53,8 @@ class SimpleGPModel(StateSpaceModel):
 
         self.beta = None
         self.inv_K = None
+        self.chol_K = None
+        self.predictor = None
         self.z = None
         self._init_kernel_function(kern_types, hyp)
         self.hyp = self._create_hyp_dict(self.base_kerns, self.kern_types)
@@ -158,14 +161,21 @@ class SimpleGPModel(StateSpaceModel):
 
         return lambda x_new, u_new: self.predict_casadi_symbolic(horzcat(x_new, u_new), linearize_mu)
 
+    def _update_predictor(self):
+        """ Rebuild the cached predictor after training data changed """
+        self.predictor = GPPredictor(self.hyp, self.kern_types, self.z, self.beta,
+                                     self.inv_K, self.chol_K)
+
     def predict_casadi_symbolic(self, x_new, compute_grads=False):
         """ Return a symbolic casadi function representing predictive mean/variance
 
         """
         assert np.shape(x_new)[0] == 1, "We only support this for a single input vector right now"
 
-        out_dict = gp_pred_function(x_new, self.hyp, self.kern_types, self.z, self.beta,
-                                    self.inv_K, True, compute_grads)
+        if self.predictor is None:
+            self._update_predictor()
+
+        out_dict = self.predictor(x_new, True, compute_grads)
         mu_new = out_dict["pred_mu"]
         sigma_new = out_dict["pred_sigma"]
         if compute_grads:
@@ -232,6 +242,7 @@ class SimpleGPModel(StateSpaceModel):
         beta = np.empty((n_beta, self.n_s_out))
 
         inv_K = [None] * self.n_s_out
+        chol_K = [None] * self.n_s_out
         process_noise = np.empty((self.n_s_out,))
         gps = [None] * self.n_s_out
 
@@ -257,6 +268,10 @@ class SimpleGPModel(StateSpaceModel):
 
             post = model_gp.posterior
             inv_K[i] = post.woodbury_inv
+            if not self.do_sparse_gp:
+                # for sparse gps woodbury_chol is the inverse cholesky of the
+                # woodbury inverse, not a factor of K + sigma^2*I
+                chol_K[i] = post.woodbury_chol
 
             beta[:, i] = post.woodbury_vector.reshape(-1, )
             process_noise[i] = model_gp.Gaussian_noise.variance
@@ -271,11 +286,13 @@ class SimpleGPModel(StateSpaceModel):
         else:
             self.z = Z
         self.inv_K = inv_K
+        self.chol_K = chol_K
         self.beta = beta
         self.gps = gps
         self.gp_trained = True
         self.x_train = X_train
         self.y_train = y_train
+        self._update_predictor()
 
     def choose_datapoints_maxvar(self, x, y, m, k=10, min_ratio_k=0.25, n_reopt_gp=1):
         """ Choose datapoints for the GP based on the maximum predicted variance criterion
@@ -369,6 +386,7 @@ class SimpleGPModel(StateSpaceModel):
         else:
             n_data = np.shape(x_new)[0]
             inv_K = [None] * self.n_s_out
+            chol_K = [None] * self.n_s_out
             if self.m is None:
                 n_beta = n_data
                 Z = x_new
@@ -404,11 +422,13 @@ class SimpleGPModel(StateSpaceModel):
                 post = self.gps[i].posterior
 
                 if noise_diag > 0.0:
-                    inv_K[i] = pdinv(post._K + float(
+                    inv_K[i], chol_K[i], _, _ = pdinv(post._K + float(
                         self.gps[i].Gaussian_noise.variance + noise_diag) * np.eye(
-                        n_beta))[0]
+                        n_beta))
                 else:
                     inv_K[i] = post.woodbury_inv
+                    if not self.do_sparse_gp:
+                        chol_K[i] = post.woodbury_chol
 
                 beta[:, i] = post.woodbury_vector.reshape(-1, )
 
@@ -416,7 +436,9 @@ class SimpleGPModel(StateSpaceModel):
             self.y_train = y_new
             self.z = Z
             self.inv_K = inv_K
+            self.chol_K = chol_K
             self.beta = beta
+            self._update_predictor()
 
     def _init_kernel_function(self, kern_types=None, hyp=None):
         """ Initialize GPy kernel functions based on name. Check if supported.
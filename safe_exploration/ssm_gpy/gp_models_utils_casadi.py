@@ -9,8 +9,15 @@ TODO: Undocumented!
 
 """
 
+import hashlib
+import os
+import subprocess
+import tempfile
+import warnings
+
 import numpy as np
-from casadi import mtimes, exp, sum2, repmat, Function, sqrt, vertcat, horzcat, SX
+from casadi import mtimes, exp, sum1, sum2, repmat, Function, sqrt, vertcat, horzcat, \
+    SX, DM, solve, jacobian, substitute, bilin, CodeGenerator, external
 from casadi import reshape as cas_reshape
 
 
@@ -21,23 +28,36 @@ def _k_rbf(x, y=None, variance=1., lengthscale=None, diag_only=False):
     n_x, dim_x = x.shape
 
     if diag_only:
-        ret = SX(n_x, )
-        ret[:] = variance
-        return ret
-
-    if y is None:
-        y = x
-    n_y, _ = np.shape(y)
+        # the diagonal of a stationary kernel is a constant vector; a
+        # broadcast multiply keeps slice-assignment nodes out of the graph
+        return variance * SX.ones(n_x, 1)
 
     if lengthscale is None:
         lengthscale = np.ones((dim_x,))
 
-    lens_x = repmat(lengthscale.reshape(1, -1), n_x)
-    lens_y = repmat(lengthscale.reshape(1, -1), n_y)
+    # hoist the reciprocal into a numeric constant; a multiplication is
+    # cheaper than a division per matrix element
+    inv_lens = 1. / np.asarray(lengthscale).reshape(1, -1)
 
-    r = _unscaled_dist(x / lens_x, y / lens_y)
+    # fused sqdist formulation with the lengthscales baked into the inputs;
+    # reuses the squared row norms of x when y is None, which _sq_dist
+    # would compute twice (SX expressions are not de-duplicated on
+    # construction)
+    x_scaled = x * repmat(inv_lens, n_x)
+    xxs = sum2(x_scaled ** 2)
+    if y is None:
+        n_y = n_x
+        y_scaled = x_scaled
+        yys = xxs
+    else:
+        n_y, _ = np.shape(y)
+        y_scaled = y * repmat(inv_lens, n_y)
+        yys = sum2(y_scaled ** 2)
 
-    return variance * exp(-0.5 * r ** 2)
+    r2 = -2 * mtimes(x_scaled, y_scaled.T) + repmat(xxs, 1, n_y) \
+         + repmat(yys.T, n_x, 1)
+
+    return variance * exp(-0.5 * r2)
 
 
 def _k_mat52(x, y=None, variance=1., lengthscale=None, diag_only=False, ARD=False):
@@ -45,9 +65,7 @@ def _k_mat52(x, y=None, variance=1., lengthscale=None, diag_only=False, ARD=Fals
     n_x, dim_x = x.shape
 
     if diag_only:
-        ret = SX(n_x, )
-        ret[:] = variance
-        return ret
+        return variance * SX.ones(n_x, 1)
 
     if y is None:
         y = x
@@ -145,22 +163,28 @@ def _k_lin(x, y=None, variances=None, diag_only=False):
         ret = sum2(var * x ** 2)
         return ret
 
-    var_x = sqrt(repmat(variances.reshape(1, -1), n_x))
+    # take the sqrt once on the numeric hyperparameters instead of on the
+    # repeated matrix
+    sqrt_var = np.sqrt(np.asarray(variances)).reshape(1, -1)
+    var_x = repmat(sqrt_var, n_x)
 
     if y is None:
         var_y = var_x
         y = x
     else:
         n_y, _ = np.shape(y)
-        var_y = sqrt(repmat(variances.reshape(1, -1), n_y))
+        var_y = repmat(sqrt_var, n_y)
 
     return mtimes(x * var_x, (y * var_y).T)
 
 
-def _unscaled_dist(x, y):
+def _sq_dist(x, y):
     """ calculate the squared distance between two sets of datapoints
 
-
+    Keeping the distance squared avoids a sqrt/square roundtrip in the
+    kernels that only need r^2 (e.g. the rbf kernel), which would
+    otherwise add two elementwise ops per pair to the expression graph
+    and can produce nan gradients for r^2 ~ 0.
 
     Source:
     https://github.com/SheffieldML/GPy/blob/devel/GPy/kern/src/stationary.py
@@ -171,10 +195,16 @@ def _unscaled_dist(x, y):
     x2sq = sum2(y ** 2)
     r2 = -2 * mtimes(x, y.T) + repmat(x1sq, 1, n_y) + repmat(x2sq.T, n_x, 1)
 
-    return sqrt(r2)
+    return r2
 
 
-def gp_pred(x, kern, beta=None, x_train=None, k_inv_training=None, pred_var=True):
+def _unscaled_dist(x, y):
+    """ calculate the distance between two sets of datapoints """
+    return sqrt(_sq_dist(x, y))
+
+
+def gp_pred(x, kern, beta=None, x_train=None, k_inv_training=None, pred_var=True,
+            chol_training=None):
     """
 
     """
@@ -190,7 +220,19 @@ def gp_pred(x, kern, beta=None, x_train=None, k_inv_training=None, pred_var=True
         pred_sigm = kern(x, diag_only=True)
 
         if not beta is None:
-            pred_sigm = pred_sigm - sum2(mtimes(k_star, k_inv_training) * k_star)
+            if not chol_training is None:
+                # diag(k* K^-1 k*^T) through a triangular solve with the
+                # cached lower cholesky factor of K + sigma^2*I; the
+                # sparse triangular factor roughly halves the flops
+                # compared to multiplying with the full K^-1
+                v = solve(DM(chol_training), k_star.T)
+                pred_sigm = pred_sigm - sum1(v * v).T
+            else:
+                # row-wise quadratic forms k_i K^-1 k_i^T as fused bilin
+                # nodes; avoids materializing the N x M product with K^-1
+                pred_sigm = pred_sigm - vertcat(
+                    *[bilin(k_inv_training, k_star[i, :].T, k_star[i, :].T)
+                      for i in range(n_pred)])
 
         return pred_mu, pred_sigm
 
@@ -231,21 +273,132 @@ def _get_kernel_function(kern_type, hyp):
         raise ValueError("Unknown kernel {}".format(kern_type))
 
 
+def _stack_hyp(hyp):
+    """ Stack a list of rbf hyperparameter dicts into arrays
+
+    Converts the array-of-structs layout (one dict per output) into a
+    struct-of-arrays layout that the batched kernel evaluation can
+    broadcast over.
+
+    Parameters
+    ----------
+    hyp: list[dict]
+        Per-output dicts with the "lengthscale" and "variance" entries.
+
+    Returns
+    -------
+    stacked_hyp: dict
+        A dict with a (n_gps, d) "lengthscale" array and a (n_gps,)
+        "variance" array.
+    """
+    lengthscales = np.stack([np.asarray(hyp_i["lengthscale"]).reshape(-1)
+                             for hyp_i in hyp])
+    variances = np.array([np.asarray(hyp_i["variance"]).reshape(-1)[0]
+                          for hyp_i in hyp])
+
+    return {"lengthscale": lengthscales, "variance": variances}
+
+
+def _k_rbf_batched(x, stacked_hyp, y=None, diag_only=False):
+    """ Evaluate a batch of rbf kernels on shared inputs
+
+    Casadi has no 3d tensors, so the batch is returned as a list of
+    (n_x, n_y) expressions. When all outputs share their lengthscales the
+    scaled squared distance is computed once and each output only applies
+    its own variance.
+    """
+    lengthscales = stacked_hyp["lengthscale"]
+    variances = stacked_hyp["variance"]
+    n_gps = len(variances)
+
+    if diag_only:
+        return [_k_rbf(x, diag_only=True, variance=variances[i])
+                for i in range(n_gps)]
+
+    if np.all(lengthscales == lengthscales[0]):
+        inv_lens = 1. / lengthscales[0].reshape(1, -1)
+        x_scaled = x * repmat(inv_lens, x.shape[0])
+        if y is None:
+            y_scaled = x_scaled
+        else:
+            y_scaled = y * repmat(inv_lens, np.shape(y)[0])
+        r2_shared = _sq_dist(x_scaled, y_scaled)
+
+        return [variances[i] * exp(-0.5 * r2_shared) for i in range(n_gps)]
+
+    return [_k_rbf(x, y, variances[i], lengthscales[i]) for i in range(n_gps)]
+
+
+def _get_precomputed_rbf_kernel_function(hyp_i, k_star):
+    """ Return an rbf kernel reusing a precomputed cross-covariance
+
+    Only valid if k_star was evaluated between the same inputs the kernel
+    is called on; only the cross-covariance call reuses it, all other
+    calls fall back to the plain rbf kernel.
+    """
+
+    def kern(x, y=None, diag_only=False):
+        if diag_only or y is None:
+            return _k_rbf(x, y=y, diag_only=diag_only, **hyp_i)
+        return k_star
+
+    return kern
+
+
+class GPPredictor:
+    """ Cached prediction quantities for repeated gp_pred_function calls
+
+    Bundles the training inputs, hyperparameters, mean cache
+    alpha = (K + sigma^2*I)^-1 y and the lower cholesky factor of
+    K + sigma^2*I, so callers that predict many times with the same
+    training data (e.g. inside an MPC or acquisition loop) do not have to
+    thread the raw (beta, k_inv_training) pair through every call. The
+    object is only valid until the training data or hyperparameters
+    change; owners are expected to rebuild it then.
+    """
+
+    def __init__(self, hyp, kern_types, x_train=None, alpha=None,
+                 k_inv_training=None, chol_training=None):
+        self.hyp = hyp
+        self.kern_types = kern_types
+        self.x_train = x_train
+        self.alpha = alpha
+        self.k_inv_training = k_inv_training
+        self.chol_training = chol_training
+
+    def __call__(self, x, pred_var=True, compute_grads=False):
+        """ Evaluate the symbolic prediction at x using the cached data """
+        return gp_pred_function(x, self.hyp, self.kern_types, self.x_train,
+                                self.alpha, self.k_inv_training, pred_var,
+                                compute_grads, self.chol_training)
+
+
 def gp_pred_function(x, hyp, kern_types, x_train=None, beta=None, k_inv_training=None,
-                     pred_var=True, compute_grads=False):
+                     pred_var=True, compute_grads=False, chol_training=None):
     """
 
     """
     n_gps = len(kern_types)
     inp = SX.sym("input", x.shape)
 
+    # when every output uses an rbf kernel, evaluate the cross-covariances
+    # in one batched call; with identical lengthscales the scaled squared
+    # distance to the training set is then computed once for all outputs
+    k_star_all = None
+    if not x_train is None and all(k == "rbf" for k in kern_types):
+        k_star_all = _k_rbf_batched(inp, _stack_hyp(hyp), x_train)
+
     out_dict = dict()
-    mu_all = []
-    pred_sigma_all = []
-    jac_mu_all = []
+
+    mu_syms = []
+    sigma_syms = []
+    jac_syms = []
 
     for i in range(n_gps):
-        kern_i = _get_kernel_function(kern_types[i], hyp[i])
+        if not k_star_all is None:
+            kern_i = _get_precomputed_rbf_kernel_function(hyp[i], k_star_all[i])
+        else:
+            kern_i = _get_kernel_function(kern_types[i], hyp[i])
         if beta is None:
             beta_i = None
         else:
@@ -253,36 +406,119 @@ def gp_pred_function(x, hyp, kern_types, x_train=None, beta=None, k_inv_training
         k_inv_i = None
         if not k_inv_training is None:
             k_inv_i = k_inv_training[i]
+        chol_i = None
+        if not chol_training is None:
+            chol_i = chol_training[i]
         if pred_var:
-            mu_new, sigma_new = gp_pred(inp, kern_i, beta_i, x_train, k_inv_i, pred_var)
-            pred_func = Function("pred_func", [inp], [mu_new, sigma_new], ["inp"],
-                                 ["mu_1", "sigma_1"])
-            F_1 = pred_func(inp=x)
-            pred_sigma = F_1["sigma_1"]
-            pred_sigma_all = horzcat(pred_sigma_all, pred_sigma)
-
+            mu_new, sigma_new = gp_pred(inp, kern_i, beta_i, x_train, k_inv_i, pred_var,
+                                        chol_i)
         else:
             mu_new = gp_pred(inp, kern_i, beta_i, x_train, k_inv_i, pred_var)
-            pred_func = Function("pred_func", [inp], [mu_new], ["inp"], ["mu_1"])
-            F_1 = pred_func(inp=x)
-
-        mu_1 = F_1["mu_1"]
-        mu_all = horzcat(mu_all, mu_1)
 
+        mu_syms.append(mu_new)
+        if pred_var:
+            sigma_syms.append(sigma_new)
         if compute_grads:
-            # jac_func = pred_func.jacobian("inp","mu_1")
+            jac_syms.append(jacobian(mu_new, inp))
+
+    # replace the symbolic placeholder by the actual input expression;
+    # equivalent to wrapping in a Function and calling it on x. Doing this
+    # in a single pass over all outputs preserves the subexpressions shared
+    # between the per-output kernels (e.g. the distance to the training
+    # set), which a per-output substitution would duplicate
+    all_exprs = substitute(mu_syms + sigma_syms + jac_syms, [inp], [x])
+
+    # concatenate once; growing the output with repeated horzcat/vertcat
+    # rebuilds the intermediate expression on every iteration, i.e.
+    # O(n_gps^2) instead of O(n_gps) construction work
+    out_dict["pred_mu"] = horzcat(*all_exprs[:n_gps])
+    if pred_var:
+        out_dict["pred_sigma"] = horzcat(*all_exprs[n_gps:2 * n_gps])
+    if compute_grads:
+        out_dict["jac_mu"] = vertcat(*all_exprs[-n_gps:])
+
+    return out_dict
+
 
-            jac_func = pred_func.factory('dmudinp', ['inp'], ['jac:mu_1:inp'])
+_compiled_pred_funcs = {}
 
-            F_1_jac = jac_func(inp=x)
-            # print(F_1_jac)
-            jac_mu = F_1_jac['jac_mu_1_inp']
-            jac_mu_all = vertcat(jac_mu_all, jac_mu)
 
-    out_dict["pred_mu"] = mu_all
+def _codegen_cache_key(hyp, kern_types, x_train, beta, k_inv_training, chol_training,
+                       n_pred, pred_var, compute_grads):
+    """ Key a compiled prediction function by its full numeric content
+
+    The training data and hyperparameters are baked into the generated
+    code, so the hash has to cover the numeric values, not just the
+    problem structure; otherwise a recompiled model would silently reuse
+    stale predictions.
+    """
+    digest = hashlib.md5()
+    arrays = [x_train, beta]
+    arrays += list(k_inv_training) if not k_inv_training is None else []
+    arrays += list(chol_training) if not chol_training is None else []
+    for arr in arrays:
+        digest.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    for hyp_i in hyp:
+        for key in sorted(hyp_i):
+            digest.update(key.encode())
+            digest.update(np.ascontiguousarray(hyp_i[key],
+                                               dtype=np.float64).tobytes())
+
+    return (tuple(kern_types), np.shape(x_train), n_pred, pred_var, compute_grads,
+            digest.hexdigest())
+
+
+def compiled_gp_pred_function(hyp, kern_types, x_train, beta, k_inv_training=None,
+                              pred_var=True, compute_grads=False, chol_training=None,
+                              n_pred=1, compiler="gcc"):
+    """ Build a natively compiled casadi Function for the gp prediction
+
+    Generates C code for the full prediction (all outputs), compiles it
+    into a shared library and loads it back via casadi.external. Intended
+    for callers that evaluate the same trained model many times
+    numerically, e.g. across solver steps; compiled functions are cached
+    per process so repeated calls with unchanged training data and
+    hyperparameters are free.
+
+    Falls back to the regular casadi Function if no C compiler is
+    available.
+
+    Returns
+    -------
+    f_pred: casadi.Function
+        A function mapping a (n_pred x d) input to pred_mu (and
+        pred_sigma / jac_mu, depending on the flags).
+    """
+    key = _codegen_cache_key(hyp, kern_types, x_train, beta, k_inv_training,
+                             chol_training, n_pred, pred_var, compute_grads)
+    if key in _compiled_pred_funcs:
+        return _compiled_pred_funcs[key]
+
+    inp = SX.sym("inp", n_pred, np.shape(x_train)[1])
+    out_dict = gp_pred_function(inp, hyp, kern_types, x_train, beta, k_inv_training,
+                                pred_var, compute_grads, chol_training)
+    out_names = ["pred_mu"]
     if pred_var:
-        out_dict["pred_sigma"] = pred_sigma_all
+        out_names += ["pred_sigma"]
     if compute_grads:
-        out_dict["jac_mu"] = jac_mu_all
-
-    return out_dict
+        out_names += ["jac_mu"]
+    f_pred = Function("gp_pred_all", [inp], [out_dict[name] for name in out_names],
+                      ["inp"], out_names)
+
+    build_dir = tempfile.mkdtemp(prefix="gp_pred_codegen_")
+    gen = CodeGenerator("gp_pred_all.c")
+    gen.add(f_pred)
+    c_file = os.path.join(build_dir, gen.generate(build_dir + os.sep))
+    so_file = os.path.join(build_dir, "gp_pred_all.so")
+    try:
+        subprocess.run([compiler, "-O3", "-march=native", "-ffast-math", "-shared",
+                        "-fPIC", c_file, "-o", so_file], check=True,
+                       capture_output=True)
+        f_pred = external("gp_pred_all", so_file)
+    except (OSError, subprocess.CalledProcessError):
+        warnings.warn("Could not compile the generated prediction code with '{}', "
+                      "using the casadi virtual machine instead".format(compiler))
+
+    _compiled_pred_funcs[key] = f_pred
+
+    return f_pred
@@ -1,10 +1,13 @@
 """Gaussian process utlilities for gpytorch."""
 
 
+import warnings
+
 import torch
 import hessian
 import gpytorch
 import numpy as np
+from scipy.linalg import cho_solve
 
 from torch.nn import ModuleList
 from gpytorch.distributions import MultivariateNormal
@@ -12,6 +15,12 @@ from safe_exploration.state_space_models import StateSpaceModel
 
 from .utilities import compute_jacobian
 
+try:
+    from .numeric_prediction import rbf_predict
+    _has_numba = True
+except ImportError:
+    _has_numba = False
+
 __all__ = ['BatchMean', 'BatchKernel', 'LinearMean', 'MultiOutputGP', 'GPyTorchSSM']
 
 
@@ -96,6 +105,8 @@ class LinearMean(gpytorch.means.Mean):
 
     def __init__(self, matrix, trainable=False, prior=None):
         super().__init__()
+        # guarantee the fast GEMV kernel in forward
+        matrix = matrix.contiguous()
         if trainable:
             self.register_parameter(name='matrix',
                                     parameter=torch.nn.Parameter(matrix))
@@ -110,7 +121,9 @@ class LinearMean(gpytorch.means.Mean):
 
     def forward(self, x):
         """Compute the linear product."""
-        return torch.einsum('ij,ilj->il', self.matrix, x)
+        # batched matrix-vector product; dispatches straight to BLAS
+        # without the einsum tracing overhead
+        return torch.matmul(x, self.matrix.unsqueeze(-1)).squeeze(-1)
 
 
 class WrappedNormal(object):
@@ -120,15 +133,33 @@ class WrappedNormal(object):
         super().__init__()
         self.normal = normal
 
-    def __getattr__(self, key):
+    def _unsqueezed(self, key):
         """Unsqueeze empty dimensions."""
         res = getattr(self.normal, key)
-        batch_shape = self.normal.batch_shape
-        if not batch_shape and key in ('mean', 'variance', 'covariance_matrix'):
+        if not self.normal.batch_shape:
             res = res.unsqueeze(0)
 
         return res
 
+    # explicit properties for the hot attributes; routing them through
+    # __getattr__ costs an attribute miss plus a membership test on every
+    # access in the prediction loops
+    @property
+    def mean(self):
+        return self._unsqueezed('mean')
+
+    @property
+    def variance(self):
+        return self._unsqueezed('variance')
+
+    @property
+    def covariance_matrix(self):
+        return self._unsqueezed('covariance_matrix')
+
+    def __getattr__(self, key):
+        """Pass all other attributes through to the wrapped distribution."""
+        return getattr(self.normal, key)
+
 
 class MultiOutputGP(gpytorch.models.ExactGP):
     """A GP model that uses the gpytorch batch mode for multi-output predictions.
@@ -165,11 +196,14 @@ class MultiOutputGP(gpytorch.models.ExactGP):
 
         self.mean = mean
         self.kernel = kernel
+        # memoize the batch size; __call__ sits in tight prediction loops
+        # and the property dispatch into the kernel is not free
+        self._batch_size = kernel.batch_size
 
     @property
     def batch_size(self):
         """Return the batch size of the model."""
-        return self.kernel.batch_size
+        return self._batch_size
 
     def set_train_data(self, inputs=None, targets=None, strict=True):
         """Set the GP training data."""
@@ -186,13 +220,23 @@ class MultiOutputGP(gpytorch.models.ExactGP):
 
     def __call__(self, *args, **kwargs):
         """Evaluate the underlying batch_mode model."""
-        if self.batch_size > 1:
-            args = [arg.unsqueeze(-1) if arg.ndimension() == 1 else arg for arg in args]
-            # Expand input arguments across batches
-            args = list(map(lambda x: x.expand(self.batch_size, *x.shape), args))
+        batch_size = self._batch_size
+        if batch_size > 1:
+            if len(args) == 1:
+                # Fast path for the common single-input evaluation
+                arg = args[0]
+                if arg.ndimension() == 1:
+                    arg = arg.unsqueeze(-1)
+                # Expand is a no-copy view across batches
+                args = (arg.expand(batch_size, *arg.shape),)
+            else:
+                args = [arg.unsqueeze(-1) if arg.ndimension() == 1 else arg
+                        for arg in args]
+                # Expand input arguments across batches
+                args = [arg.expand(batch_size, *arg.shape) for arg in args]
         normal = super().__call__(*args, **kwargs)
 
-        if self.batch_size > 1:
+        if batch_size > 1:
             return normal
         else:
             return WrappedNormal(normal)
@@ -210,18 +254,110 @@ class GPyTorchSSM(StateSpaceModel):
 
     """
 
-    def __init__(self, num_states, num_actions, train_x, train_y, kernel, likelihood, mean=None):
+    def __init__(self, num_states, num_actions, train_x, train_y, kernel, likelihood, mean=None,
+                 use_numba=False, precision="float32"):
         """ """
 
         # check compatability of the parameters required for super classes
         assert np.shape(train_x)[1] == num_states + num_actions, "Input needs to have dimensions N x(n + m)"
         assert np.shape(train_y)[0] == num_states, "Input needs to have dimensions N x n"
 
+        if precision not in ("float32", "float64"):
+            raise ValueError("precision needs to be 'float32' or 'float64', "
+                             "got '{}'".format(precision))
+        self.precision = precision
+        # float32 halves the bytes moved in the matmul-heavy kernel
+        # evaluations and is sufficient for the moderate training set
+        # sizes used here; float64 is an opt-in for accuracy-critical use
+        self._np_dtype = np.float32 if precision == "float32" else np.float64
+
         self.pytorch_gp = MultiOutputGP(train_x, train_y, kernel, likelihood, mean)
+        if precision == "float64":
+            self.pytorch_gp.double()
         self.pytorch_gp.eval()
 
+        if use_numba and not _has_numba:
+            warnings.warn("Optional dependency 'numba' not available, "
+                          "falling back to the gpytorch predict path")
+            use_numba = False
+        self.use_numba = use_numba
+        # caches the numeric kernel quantities derived from the current
+        # hyperparameters; call invalidate_numba_cache() after changing
+        # them (e.g. after optimizing pytorch_gp.loss)
+        self._numba_cache = None
+
         super(GPyTorchSSM, self).__init__(num_states, num_actions, True, True)
 
+    def invalidate_numba_cache(self):
+        """ Discard the cached quantities of the jitted predict path
+
+        The jitted rbf path caches training data, cholesky factors and
+        kernel hyperparameters on the first prediction. Call this after
+        changing the model (e.g. after a hyperparameter optimization loop
+        over pytorch_gp.loss), otherwise predictions with use_numba keep
+        using the stale hyperparameters.
+        """
+        self._numba_cache = None
+
+    def _build_numba_cache(self):
+        """ Extract the numeric quantities for the jitted rbf predict path
+
+        Returns None if the model is not a (batch of) plain rbf kernel(s)
+        with a zero mean, in which case predictions go through gpytorch.
+        """
+        gp = self.pytorch_gp
+        if not isinstance(gp.mean, gpytorch.means.ZeroMean):
+            return None
+
+        n_in = self.num_states + self.num_actions
+
+        if isinstance(gp.kernel, BatchKernel):
+            kernels = list(gp.kernel)
+        else:
+            kernels = [gp.kernel]
+
+        scale_kernel = getattr(gpytorch.kernels, "ScaleKernel", None)
+        lengthscales = []
+        variances = []
+        for kern in kernels:
+            variance = 1.
+            if scale_kernel is not None and isinstance(kern, scale_kernel):
+                variance = float(kern.outputscale)
+                kern = kern.base_kernel
+            if not isinstance(kern, gpytorch.kernels.RBFKernel):
+                return None
+            lens = np.asarray(kern.lengthscale.detach()).reshape(-1)
+            lengthscales.append(lens * np.ones((n_in,)))
+            variances.append(variance)
+
+        lengthscales = np.array(lengthscales)
+        variances = np.array(variances)
+
+        x_train = gp.train_inputs[0].detach()
+        if x_train.dim() == 3:  # expanded across the batch, all slices equal
+            x_train = x_train[0]
+        x_train = np.asarray(x_train, dtype=np.float64)
+
+        y_train = gp.train_targets.detach()
+        if y_train.dim() == 1:
+            y_train = y_train.unsqueeze(0)
+        y_train = np.asarray(y_train, dtype=np.float64)
+
+        noise = np.asarray(gp.likelihood.noise.detach()).reshape(-1) \
+                * np.ones((len(kernels),))
+
+        n_data = x_train.shape[0]
+        beta = np.empty((len(kernels), n_data))
+        chol = np.empty((len(kernels), n_data, n_data))
+        for i in range(len(kernels)):
+            scaled = x_train / lengthscales[i]
+            r2 = ((scaled[:, None, :] - scaled[None, :, :]) ** 2).sum(-1)
+            k_mat = variances[i] * np.exp(-0.5 * r2) + noise[i] * np.eye(n_data)
+            chol[i] = np.linalg.cholesky(k_mat)
+            beta[i] = cho_solve((chol[i], True), y_train[i])
+
+        return x_train, beta, chol, lengthscales, variances
+
     def _compute_hessian_mean(self, states, actions):
         """ Generate the hessian of the mean prediction
 
@@ -238,9 +374,10 @@ class GPyTorchSSM(StateSpaceModel):
 
         """
 
-        inp = torch.cat((torch.from_numpy(np.array(states, dtype=np.float32)), torch.from_numpy(np.array(actions, dtype=np.float32))), dim=1)
-        inp.requires_grad = True
+        inp = torch.cat((torch.as_tensor(np.asarray(states, dtype=self._np_dtype)),
+                         torch.as_tensor(np.asarray(actions, dtype=self._np_dtype))), dim=1)
         n_in = self.num_states + self.num_actions
+        inp.requires_grad = True
 
         hess_mean = torch.empty(self.num_states, n_in, n_in)
         for i in range(self.num_states):  # unfortunately hessian only works for scalar outputs
@@ -323,11 +460,23 @@ class GPyTorchSSM(StateSpaceModel):
         jacobian_variance : np.ndarray
             Only supported without the full_cov flag.
         """
-
-        out = self._predict(torch.from_numpy(np.array(states, dtype=np.float32)),
-                            torch.from_numpy(np.array(actions, dtype=np.float32)),
+        if self.use_numba and not jacobians and not full_cov:
+            if self._numba_cache is None:
+                self._numba_cache = self._build_numba_cache()
+                if self._numba_cache is None:
+                    warnings.warn("The jitted predict path only supports rbf "
+                                  "kernels with a zero mean, falling back to "
+                                  "the gpytorch path")
+                    self.use_numba = False
+            if self._numba_cache is not None:
+                inp = np.concatenate((np.asarray(states, dtype=np.float64),
+                                      np.asarray(actions, dtype=np.float64)), axis=1)
+                return rbf_predict(inp, *self._numba_cache)
+
+        out = self._predict(torch.as_tensor(np.ascontiguousarray(states, dtype=self._np_dtype)),
+                            torch.as_tensor(np.ascontiguousarray(actions, dtype=self._np_dtype)),
                             jacobians,
-                                full_cov)
+                            full_cov)
         return tuple([var.detach().numpy() for var in out])
 
     def linearize_predict(self, states, actions, jacobians=False, full_cov=False):
@@ -366,8 +515,8 @@ class GPyTorchSSM(StateSpaceModel):
             raise NotImplementedError("""'linearize_predict' currently only allows for single
                                           inputs, i.e. (1 x n) arrays, when computing jacobians.""")
 
-        out = self._predict(torch.from_numpy(np.array(states, dtype=np.float32)),
-                            torch.from_numpy(np.array(actions, dtype=np.float32)),
+        out = self._predict(torch.as_tensor(np.ascontiguousarray(states, dtype=self._np_dtype)),
+                            torch.as_tensor(np.ascontiguousarray(actions, dtype=self._np_dtype)),
                             True,
                             full_cov)
 
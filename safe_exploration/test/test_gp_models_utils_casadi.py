@@ -14,9 +14,11 @@ from casadi import Function, SX
 
 try:
     from safe_exploration.ssm_gpy.gp_models_utils_casadi import _unscaled_dist, _k_rbf, _k_lin, _k_lin_rbf, \
-    _k_mat52
+    _k_mat52, _stack_hyp, _k_rbf_batched, gp_pred_function, GPPredictor, \
+    compiled_gp_pred_function
 
     from GPy.kern import RBF, Linear, Matern52
+    from GPy.models import GPRegression
     _has_ssm_gp = True
 except:
     _has_ssm_gp = False
@@ -121,6 +123,36 @@ def test_k_mat52(before_gp_utils_casadi_test_rbf):
     assert np.all(np.isclose(f_out_casadi, f_out_gpy))
 
 
+@pytest.mark.parametrize("shared_lengthscales", [True, False])
+def test_k_rbf_batched(before_gp_utils_casadi_test_rbf, shared_lengthscales):
+    """ Does _k_rbf_batched match the per-output GPy evaluation? """
+
+    x_inp, y_inp, n_dim = before_gp_utils_casadi_test_rbf
+    n_gps = 3
+    if shared_lengthscales:
+        ls = [np.random.rand(n_dim, ) + 1] * n_gps
+    else:
+        ls = [np.random.rand(n_dim, ) + 1 for _ in range(n_gps)]
+    rbf_var = [np.random.rand() + 1 for _ in range(n_gps)]
+
+    hyp = [{"lengthscale": ls[i], "variance": rbf_var[i]} for i in range(n_gps)]
+    stacked_hyp = _stack_hyp(hyp)
+
+    x = SX.sym("x", np.shape(x_inp))
+    for i in range(n_gps):
+        if y_inp is None:
+            f = Function("f", [x], [_k_rbf_batched(x, stacked_hyp)[i]])
+            f_out_casadi = f(x_inp)
+        else:
+            y = SX.sym("y", np.shape(y_inp))
+            f = Function("f", [x, y], [_k_rbf_batched(x, stacked_hyp, y)[i]])
+            f_out_casadi = f(x_inp, y_inp)
+
+        kern_rbf = RBF(n_dim, rbf_var[i], ls[i], True)
+        f_out_gpy = kern_rbf.K(x_inp, y_inp)
+        assert np.all(np.isclose(f_out_casadi, f_out_gpy))
+
+
 def test_k_lin_rbf(before_gp_utils_casadi_test_rbf):
     """ Does _k_rbf_ show the same behaviours as the GPy implementation?"""
 
@@ -152,3 +184,115 @@ def test_k_lin_rbf(before_gp_utils_casadi_test_rbf):
 
     f_out_gpy = kern_lin.K(x_inp, y_inp)
     assert np.all(np.isclose(f_out_casadi, f_out_gpy))
+
+
+@pytest.fixture
+def before_gp_pred_test():
+    """ Train a pair of exact GPy models and extract the prediction caches """
+
+    if not _has_ssm_gp:
+        pytest.skip("Test requires optional dependencies 'ssm_gp'")
+
+    np.random.seed(125)
+    n_data, n_dim, n_gps = 20, 3, 2
+    x_train = np.random.rand(n_data, n_dim)
+    y_train = np.random.rand(n_data, n_gps)
+
+    gps, hyp, kern_types, inv_K, chol_K = [], [], [], [], []
+    beta = np.empty((n_data, n_gps))
+    for i in range(n_gps):
+        kern = RBF(n_dim, np.random.rand() + 1, np.random.rand(n_dim, ) + 1, True)
+        model_gp = GPRegression(x_train, y_train[:, i, None], kernel=kern)
+        gps += [model_gp]
+        post = model_gp.posterior
+        inv_K += [post.woodbury_inv]
+        chol_K += [post.woodbury_chol]
+        beta[:, i] = post.woodbury_vector.reshape(-1, )
+        hyp += [{"lengthscale": np.array(kern.lengthscale),
+                 "variance": np.array(kern.variance)}]
+        kern_types += ["rbf"]
+
+    return gps, hyp, kern_types, x_train, beta, inv_K, chol_K
+
+
+def test_gp_pred_function_chol_matches_k_inv(before_gp_pred_test):
+    """ Do the cholesky and inverse based variances agree with GPy? """
+    gps, hyp, kern_types, x_train, beta, inv_K, chol_K = before_gp_pred_test
+    x_test = np.random.rand(1, x_train.shape[1])
+    x = SX.sym("x", np.shape(x_test))
+
+    out_inv = gp_pred_function(x, hyp, kern_types, x_train, beta, inv_K)
+    out_chol = gp_pred_function(x, hyp, kern_types, x_train, beta, inv_K,
+                                chol_training=chol_K)
+    f_inv = Function("f", [x], [out_inv["pred_mu"], out_inv["pred_sigma"]])
+    f_chol = Function("f", [x], [out_chol["pred_mu"], out_chol["pred_sigma"]])
+
+    mu_inv, sigma_inv = f_inv(x_test)
+    mu_chol, sigma_chol = f_chol(x_test)
+    mu_gpy = np.hstack([gp.predict_noiseless(x_test)[0] for gp in gps])
+    sigma_gpy = np.hstack([gp.predict_noiseless(x_test)[1] for gp in gps])
+
+    assert np.all(np.isclose(mu_chol, mu_inv))
+    assert np.all(np.isclose(sigma_chol, sigma_inv))
+    assert np.all(np.isclose(mu_chol, mu_gpy))
+    assert np.all(np.isclose(sigma_chol, sigma_gpy))
+
+
+def test_gp_predictor_call(before_gp_pred_test):
+    """ Does GPPredictor.__call__ reproduce the gp_pred_function outputs? """
+    gps, hyp, kern_types, x_train, beta, inv_K, chol_K = before_gp_pred_test
+    x_test = np.random.rand(1, x_train.shape[1])
+    x = SX.sym("x", np.shape(x_test))
+
+    predictor = GPPredictor(hyp, kern_types, x_train, beta, inv_K,
+                            chol_training=chol_K)
+    out_pred = predictor(x, pred_var=True, compute_grads=True)
+    out_ref = gp_pred_function(x, hyp, kern_types, x_train, beta, inv_K,
+                               pred_var=True, compute_grads=True,
+                               chol_training=chol_K)
+
+    keys = ["pred_mu", "pred_sigma", "jac_mu"]
+    f_pred = Function("f", [x], [out_pred[key] for key in keys])
+    f_ref = Function("f", [x], [out_ref[key] for key in keys])
+
+    for o_pred, o_ref in zip(f_pred(x_test), f_ref(x_test)):
+        assert np.all(np.isclose(np.array(o_pred), np.array(o_ref)))
+
+
+def test_compiled_gp_pred_function(before_gp_pred_test):
+    """ Does the natively compiled prediction agree with GPy? """
+    gps, hyp, kern_types, x_train, beta, inv_K, chol_K = before_gp_pred_test
+    x_test = np.random.rand(1, x_train.shape[1])
+
+    f_pred = compiled_gp_pred_function(hyp, kern_types, x_train, beta, inv_K)
+    mu, sigma = f_pred(x_test)
+
+    mu_gpy = np.hstack([gp.predict_noiseless(x_test)[0] for gp in gps])
+    sigma_gpy = np.hstack([gp.predict_noiseless(x_test)[1] for gp in gps])
+
+    assert np.all(np.isclose(np.array(mu), mu_gpy))
+    assert np.all(np.isclose(np.array(sigma), sigma_gpy))
+
+    # unchanged model: the compiled function is served from the cache
+    f_cached = compiled_gp_pred_function(hyp, kern_types, x_train, beta, inv_K)
+    assert f_cached is f_pred
+
+
+def test_compiled_gp_pred_function_no_compiler(before_gp_pred_test):
+    """ Does the codegen fall back to the casadi vm without a compiler? """
+    gps, hyp, kern_types, x_train, beta, inv_K, chol_K = before_gp_pred_test
+    x_test = np.random.rand(1, x_train.shape[1])
+
+    # compute_grads=True keys this differently from the compiled test
+    # above, so the cache cannot serve a natively compiled function
+    with pytest.warns(UserWarning):
+        f_pred = compiled_gp_pred_function(hyp, kern_types, x_train, beta, inv_K,
+                                           compute_grads=True,
+                                           compiler="no-such-compiler")
+    mu, sigma, jac = f_pred(x_test)
+
+    mu_gpy = np.hstack([gp.predict_noiseless(x_test)[0] for gp in gps])
+    sigma_gpy = np.hstack([gp.predict_noiseless(x_test)[1] for gp in gps])
+
+    assert np.all(np.isclose(np.array(mu), mu_gpy))
+    assert np.all(np.isclose(np.array(sigma), sigma_gpy))
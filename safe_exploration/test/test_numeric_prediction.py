@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Tests for the jitted numeric rbf prediction path.
+
+@author: tkoller
+"""
+import importlib.util
+import os.path
+
+import numpy as np
+import pytest
+from scipy.linalg import cho_solve
+
+try:
+    # the module only depends on numpy/numba; load it directly so the test
+    # also runs when the optional torch/gpytorch dependencies are missing
+    _module_path = os.path.join(os.path.dirname(__file__), "..", "ssm_pytorch",
+                                "numeric_prediction.py")
+    _spec = importlib.util.spec_from_file_location("numeric_prediction",
+                                                   _module_path)
+    _numeric_prediction = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_numeric_prediction)
+    rbf_predict = _numeric_prediction.rbf_predict
+    _has_numba = True
+except:
+    _has_numba = False
+
+try:
+    from safe_exploration.ssm_pytorch import GPyTorchSSM, BatchKernel
+    import gpytorch
+    import torch
+
+    _has_ssm_gpytorch = True
+except:
+    _has_ssm_gpytorch = False
+
+
+@pytest.fixture
+def before_test_rbf_predict():
+    if not _has_numba:
+        pytest.skip("Optional dependency 'numba' required to run this test")
+    np.random.seed(125)
+    n_data = 15
+    n_in = 3
+    n_out = 2
+    x_train = np.random.randn(n_data, n_in)
+    y_train = np.random.randn(n_out, n_data)
+    lengthscales = np.random.rand(n_out, n_in) + 0.5
+    variances = np.random.rand(n_out) + 0.5
+    noise = 0.1
+
+    beta = np.empty((n_out, n_data))
+    chol = np.empty((n_out, n_data, n_data))
+    for i in range(n_out):
+        scaled = x_train / lengthscales[i]
+        r2 = ((scaled[:, None, :] - scaled[None, :, :]) ** 2).sum(-1)
+        k_mat = variances[i] * np.exp(-0.5 * r2) + noise * np.eye(n_data)
+        chol[i] = np.linalg.cholesky(k_mat)
+        beta[i] = cho_solve((chol[i], True), y_train[i])
+
+    return x_train, y_train, beta, chol, lengthscales, variances
+
+
+def test_rbf_predict_matches_numpy_reference(before_test_rbf_predict):
+    """ the jitted predictions match the standard cholesky-based equations """
+    x_train, y_train, beta, chol, lengthscales, variances = before_test_rbf_predict
+    n_out = beta.shape[0]
+    x = np.random.randn(6, x_train.shape[1])
+
+    mu, var = rbf_predict(x, x_train, beta, chol, lengthscales, variances)
+
+    for i in range(n_out):
+        scaled_train = x_train / lengthscales[i]
+        scaled_x = x / lengthscales[i]
+        r2 = ((scaled_x[:, None, :] - scaled_train[None, :, :]) ** 2).sum(-1)
+        k_star = variances[i] * np.exp(-0.5 * r2)
+        mu_ref = k_star.dot(beta[i])
+        v = np.linalg.solve(chol[i], k_star.T)
+        var_ref = variances[i] - (v ** 2).sum(0)
+
+        assert np.allclose(mu[i], mu_ref)
+        assert np.allclose(var[i], var_ref)
+
+
+def test_rbf_predict_interpolates_training_targets(before_test_rbf_predict):
+    """ with low noise the predictive mean reproduces the training targets """
+    x_train, y_train, _, _, lengthscales, variances = before_test_rbf_predict
+    n_out, n_data = y_train.shape
+    noise = 1e-10
+
+    beta = np.empty((n_out, n_data))
+    chol = np.empty((n_out, n_data, n_data))
+    for i in range(n_out):
+        scaled = x_train / lengthscales[i]
+        r2 = ((scaled[:, None, :] - scaled[None, :, :]) ** 2).sum(-1)
+        k_mat = variances[i] * np.exp(-0.5 * r2) + noise * np.eye(n_data)
+        chol[i] = np.linalg.cholesky(k_mat)
+        beta[i] = cho_solve((chol[i], True), y_train[i])
+
+    mu, var = rbf_predict(x_train, x_train, beta, chol, lengthscales, variances)
+
+    assert np.allclose(mu, y_train, atol=1e-4)
+    assert np.allclose(var, 0., atol=1e-4)
+
+
+@pytest.fixture
+def before_test_gpytorch_ssm(check_has_ssm_pytorch):
+    torch.manual_seed(125)
+    n_s = 2
+    n_u = 1
+    n_data = 10
+    train_x = torch.randn(n_data, n_s + n_u)
+    train_y = torch.randn(n_s, n_data)
+    kernel = BatchKernel([gpytorch.kernels.RBFKernel()] * n_s)
+    likelihood = gpytorch.likelihoods.GaussianLikelihood(batch_size=n_s)
+
+    return GPyTorchSSM(n_s, n_u, train_x, train_y, kernel, likelihood,
+                       use_numba=True)
+
+
+def test_invalidate_numba_cache(before_test_gpytorch_ssm):
+    """ invalidation discards the cached hyperparameter-dependent quantities """
+    ssm = before_test_gpytorch_ssm
+    states = np.random.randn(1, ssm.num_states)
+    actions = np.random.randn(1, ssm.num_actions)
+
+    ssm.predict(states, actions)
+    assert ssm._numba_cache is not None
+
+    ssm.invalidate_numba_cache()
+    assert ssm._numba_cache is None